@@ -5,12 +5,38 @@ from pymilvus import (
     CollectionSchema,
     Collection)
 import sqlite3
+from math import sqrt
 
 
 import os
 db_dir = os.path.dirname(__file__)
 client = MilvusClient(os.path.join(db_dir, "milvus_storage.db"))
 
+# FLAT beats IVF on small corpora, switch once brute force gets expensive
+IVF_ROW_THRESHOLD = 10_000
+# Milvus Lite (local milvus_storage.db) only builds FLAT, IVF_FLAT and AUTOINDEX, so the
+# quantized IVF variants aren't an option here
+IVF_INDEX_TYPE = "IVF_FLAT"
+# embeddings are unit length, so inner product ranks the same as L2 with less work
+VECTOR_METRIC_TYPE = "IP"
+
+def vector_index_params(row_count):
+    index_params = client.prepare_index_params()
+    if row_count > IVF_ROW_THRESHOLD:
+        index_params.add_index(
+            field_name="embedding",
+            index_type=IVF_INDEX_TYPE,
+            metric_type=VECTOR_METRIC_TYPE,
+            params={"nlist": max(128, int(sqrt(row_count)))}
+        )
+    else:
+        index_params.add_index(
+            field_name="embedding",
+            index_type="FLAT",
+            metric_type=VECTOR_METRIC_TYPE
+        )
+    return index_params
+
 if not client.has_collection("clip_embeddings"):
     fields = [
         FieldSchema(name="id", dtype=DataType.INT64, is_primary=True, auto_id=True),
@@ -24,13 +50,34 @@ if not client.has_collection("clip_embeddings"):
         schema=schema
     )
 
-    index_params = client.prepare_index_params()
-    index_params.add_index(
-        field_name="embedding",
-        index_type="FLAT",  
-        metric_type="L2"
-    )
-    client.create_index("clip_embeddings", index_params)
+    client.create_index("clip_embeddings", vector_index_params(0))
+
+def create_vector_index(row_count):
+    try:
+        client.create_index("clip_embeddings", vector_index_params(row_count))
+    except Exception as e:
+        if row_count <= IVF_ROW_THRESHOLD:
+            raise
+        # never leave the collection without an index, searches fail outright otherwise
+        print(f"⚠️ Could not build {IVF_INDEX_TYPE} index ({e}), falling back to FLAT")
+        client.create_index("clip_embeddings", vector_index_params(0))
+
+# rebuild the index as IVF once the corpus outgrows brute force, or if it was built with another
+# metric; this only runs with this script (the server doesn't check row counts), so re-run it
+# after the corpus grows past IVF_ROW_THRESHOLD
+row_count = client.get_collection_stats("clip_embeddings")["row_count"]
+index_type = IVF_INDEX_TYPE if row_count > IVF_ROW_THRESHOLD else "FLAT"
+index_names = client.list_indexes("clip_embeddings", field_name="embedding")
+if not index_names:
+    # e.g. an earlier run dropped the index and failed to build its replacement
+    client.release_collection("clip_embeddings")
+    create_vector_index(row_count)
+for index_name in index_names:
+    index = client.describe_index("clip_embeddings", index_name)
+    if index["index_type"] != index_type or index["metric_type"] != VECTOR_METRIC_TYPE:
+        client.release_collection("clip_embeddings")
+        client.drop_index("clip_embeddings", index_name)
+        create_vector_index(row_count)
 
 client.load_collection("clip_embeddings")
 
@@ -51,5 +98,8 @@ db_cursor.execute("""
                       video_id TEXT
                   )
                   """)
+# tag lookups and the videos/tags join filter on these columns
+db_cursor.execute("CREATE INDEX IF NOT EXISTS idx_tags_tag ON tags(tag)")
+db_cursor.execute("CREATE INDEX IF NOT EXISTS idx_tags_video_id ON tags(video_id)")
 db_conn.commit()
 db_conn.close()
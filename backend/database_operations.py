@@ -1,107 +1,235 @@
 from pymilvus import MilvusClient
 import sqlite3
+import os
+import asyncio
+import threading
+import functools
+import json
 import numpy as np
+from typing import Optional
 
 MILVUS_COLLECTION_NAME = "clip_embeddings"
+# cap on in-flight insert chunks; 2 is a starting point taken from a Qdrant tuning note,
+# not measured against this backend, so it can be overridden like MILVUS_BATCH_SIZE
+MILVUS_INSERT_CONCURRENCY = int(os.getenv("MILVUS_INSERT_CONCURRENCY", "2"))
+SEARCH_CACHE_SIZE = 512
+
+# the collection is searched by inner product, which only matches L2 ranking for unit vectors
+def normalize_vectors(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    if vectors.ndim == 1:
+        vectors = vectors.reshape(1, -1)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
 class DatabaseOperations():
+    # SQL kept as constants so every call hits the same sqlite statement cache entry
+    _QUERY_VIDEO_SQL = "SELECT * FROM videos WHERE id = ?"
+    _QUERY_VIDEO_ALL_SQL = "SELECT * FROM videos"
+    _INSERT_VIDEO_SQL = "INSERT into videos (id,title,transcript,timestamp) VALUES (?,?,?,?) RETURNING *"
+    _QUERY_TAGS_BY_TAG_SQL = "SELECT * FROM tags where tag = ?"
+    _QUERY_DISTINCT_TAGS_SQL = "SELECT DISTINCT tag from tags"
+    _INSERT_TAG_SQL = "INSERT into tags (tag,video_id) VALUES (?,?)"
+    _QUERY_TAGS_BY_VIDEO_SQL = "SELECT tag FROM tags WHERE video_id = ?"
+    # id lists are bound as one JSON array so the statement text stays constant
+    _QUERY_VIDEOS_BY_IDS_SQL = "SELECT * FROM videos WHERE id IN (SELECT value FROM json_each(?))"
+    _QUERY_TAGS_BY_VIDEO_IDS_SQL = "SELECT video_id, tag FROM tags WHERE video_id IN (SELECT value FROM json_each(?))"
+    _QUERY_VIDEOS_BY_TAG_SQL = (
+        "SELECT videos.id, videos.title, videos.transcript, videos.timestamp "
+        "FROM videos LEFT JOIN tags ON videos.id = tags.video_id WHERE tags.tag = ?"
+    )
+
     def __init__(self):
-        self.sqlite_conn = sqlite3.connect(
-            'database/sqlite.db', 
-            timeout=20, 
-            check_same_thread=False
-        )
-        import os
         db_dir = os.path.join(os.path.dirname(__file__), 'database')
         self.milvus_conn = MilvusClient(os.path.join(db_dir, 'milvus_storage.db'))
-        self.sqlite_conn = sqlite3.connect(os.path.join(db_dir, 'sqlite.db'))
+        # repeated queries skip the ANN scan; the generation is part of the key and is bumped
+        # after every insert, so a search that was in flight during an insert can't store a
+        # stale result under the key later searches use
+        self._cached_search = functools.lru_cache(maxsize=SEARCH_CACHE_SIZE)(self._search)
+        self._search_generation = 0
+        self.sqlite_conn = sqlite3.connect(
+            os.path.join(db_dir, 'sqlite.db'),
+            timeout=20,
+            check_same_thread=False,
+            cached_statements=512,
+            isolation_level=None
+        )
         self.cursor = self.sqlite_conn.cursor()
+        # one connection is shared by every request thread, so serialize cursor use
+        self._lock = threading.Lock()
+        self.cursor.execute("PRAGMA journal_mode=WAL")
+        self.cursor.execute("PRAGMA synchronous=NORMAL")
+        self.cursor.execute("PRAGMA temp_store=MEMORY")
+        self.cursor.execute("PRAGMA mmap_size=268435456")
         
     def search_vector_table(self,vector_data):
+        generation = self._search_generation
+        return self._cached_search(normalize_vectors(vector_data)[0].tobytes(), generation)
+
+    def _search(self, vector_bytes, generation):
         response = self.milvus_conn.search(
             collection_name=MILVUS_COLLECTION_NAME,
             anns_field= "embedding",
-            data = [vector_data],
-            search_params= {"metric_type": "L2", "params": {"nprobe": 10}},
+            data = [np.frombuffer(vector_bytes, dtype=np.float32)],
+            search_params= {"metric_type": "IP", "params": {"nprobe": 10}},
             limit=10,
-            output_fields=["video_id"]
+            output_fields=["video_id"],
+            # results are cached until the next insert, so they must include every insert so far
+            consistency_level="Strong"
         )
         return response
     
-    def insert_vector_table(self, vector_data, video_id):
-        if hasattr(vector_data, "tolist"):
-            vector_list = vector_data.tolist()
-        else:
-            vector_list = vector_data
+    async def insert_vector_table_batch(self, vectors, video_id):
+        vectors = normalize_vectors(vectors)
+        if len(vectors) == 0:
+            return []
 
-        data = [
+        # split into chunks so a long video can't exceed the gRPC message size limit
+        chunk = int(os.getenv("MILVUS_BATCH_SIZE", "1000"))
+        # rows hold float32 ndarray views of the normalized batch; pymilvus converts them itself
+        rows = [
             {
-                "embedding": vector_list,  
+                "embedding": vector,
                 "video_id": str(video_id)
             }
+            for vector in vectors
         ]
-        
-        response = self.milvus_conn.insert(
-            collection_name="clip_embeddings",
-            data=data
+
+        # MilvusClient is blocking, so run each chunk's insert in a worker thread
+        semaphore = asyncio.Semaphore(MILVUS_INSERT_CONCURRENCY)
+
+        async def insert_chunk(data):
+            async with semaphore:
+                return await asyncio.to_thread(
+                    self.milvus_conn.insert,
+                    collection_name=MILVUS_COLLECTION_NAME,
+                    data=data
+                )
+
+        responses = await asyncio.gather(
+            *[insert_chunk(rows[i:i + chunk]) for i in range(0, len(rows), chunk)]
         )
-        return response
+        self._search_generation += 1
+        # entries from older generations can never be hit again, free them
+        self._cached_search.cache_clear()
+        return responses
+
+    async def insert_vector_table(self, vector_data, video_id):
+        return await self.insert_vector_table_batch(vector_data, video_id)
      
     def query_video_table(self,video_id):
-        self.cursor.execute(
-            "SELECT * FROM videos WHERE id = ?", 
-            (video_id,)                         
-        )
-        return self.cursor.fetchall()[0]
+        with self._lock:
+            self.cursor.execute(
+                self._QUERY_VIDEO_SQL,
+                (video_id,)
+            )
+            return self.cursor.fetchall()[0]
     
     def query_video_table_all(self):
-        self.cursor.execute(
-            "SELECT * FROM videos"                       
-        )
-        return self.cursor.fetchall()
+        with self._lock:
+            self.cursor.execute(
+                self._QUERY_VIDEO_ALL_SQL
+            )
+            return self.cursor.fetchall()
     
     def insert_video_table(self,video_id,title,transcript,timestamp):
-        self.cursor.execute(
-            "INSERT into videos (id,title,transcript,timestamp) VALUES (?,?,?,?)",
-            (video_id,title,transcript,timestamp)
-        ) 
-        self.sqlite_conn.commit()
+        with self._lock:
+            self.cursor.execute(
+                self._INSERT_VIDEO_SQL,
+                (video_id,title,transcript,timestamp)
+            )
+            # same row shape as query_video_table, without a second statement
+            return self.cursor.fetchone()
     
     def query_tags_table_by_tag(self,tag):
-        
-        self.cursor.execute(
-            "SELECT * FROM tags where tag = ?",
-            (tag,)
-        )
-        return self.cursor.fetchall()
+        with self._lock:
+            self.cursor.execute(
+                self._QUERY_TAGS_BY_TAG_SQL,
+                (tag,)
+            )
+            return self.cursor.fetchall()
     
     def query_tags_table_get_tags(self):
-        self.cursor.execute(
-            "SELECT DISTINCT tag from tags"
-        )
-        res = self.cursor.fetchall()
-        res = [data[0] for data in res]
-        return res
+        with self._lock:
+            self.cursor.execute(
+                self._QUERY_DISTINCT_TAGS_SQL
+            )
+            res = self.cursor.fetchall()
+            res = [data[0] for data in res]
+            return res
     def insert_tags_table(self,tag,video_id):
-        self.cursor.execute(
-            "INSERT into tags (tag,video_id) VALUES (?,?)",
-            (tag,video_id)
-        ) 
-        self.sqlite_conn.commit()
+        with self._lock:
+            self.cursor.execute(
+                self._INSERT_TAG_SQL,
+                (tag,video_id)
+            )
+
+    def insert_tags_table_many(self, pairs):
+        with self._lock:
+            # one transaction for all of a video's tags instead of a commit per row
+            self.cursor.execute("BEGIN")
+            try:
+                self.cursor.executemany(self._INSERT_TAG_SQL, pairs)
+            except Exception:
+                self.cursor.execute("ROLLBACK")
+                raise
+            self.cursor.execute("COMMIT")
     
     def query_tags_table_by_video_id(self, video_id):
-        self.cursor.execute(
-            "SELECT tag FROM tags WHERE video_id = ?",
-            (video_id,)
-        )
-        res = self.cursor.fetchall()
-        return [data[0] for data in res]
+        with self._lock:
+            self.cursor.execute(
+                self._QUERY_TAGS_BY_VIDEO_SQL,
+                (video_id,)
+            )
+            res = self.cursor.fetchall()
+            return [data[0] for data in res]
+    
+    def query_videos_by_ids(self, video_ids):
+        with self._lock:
+            self.cursor.execute(
+                self._QUERY_VIDEOS_BY_IDS_SQL,
+                (json.dumps(list(video_ids)),)
+            )
+            return self.cursor.fetchall()
+
+    def query_tags_by_video_ids(self, video_ids):
+        with self._lock:
+            self.cursor.execute(
+                self._QUERY_TAGS_BY_VIDEO_IDS_SQL,
+                (json.dumps(list(video_ids)),)
+            )
+            res = self.cursor.fetchall()
+        tags_by_video = {}
+        for video_id, tag in res:
+            tags_by_video.setdefault(video_id, []).append(tag)
+        return tags_by_video
     
     def get_videos_from_tags(self,tag):
-        self.cursor.execute(
-            "SELECT videos.id, videos.title, videos.transcript, videos.timestamp FROM videos LEFT JOIN tags ON videos.id = tags.video_id WHERE tags.tag = ?",
-            (tag,)
-        )
-        return self.cursor.fetchall()
+        with self._lock:
+            self.cursor.execute(
+                self._QUERY_VIDEOS_BY_TAG_SQL,
+                (tag,)
+            )
+            return self.cursor.fetchall()
     def close(self):
-        self.sqlite_conn.close()
+        with self._lock:
+            self.sqlite_conn.close()
+
+
+_db_instance: Optional[DatabaseOperations] = None
+
+
+def get_db() -> DatabaseOperations:
+    global _db_instance
+    if _db_instance is None:
+        _db_instance = DatabaseOperations()
+    return _db_instance
+
+
+def close_db():
+    global _db_instance
+    if _db_instance is not None:
+        _db_instance.close()
+        _db_instance = None
+
 
@@ -1,5 +1,6 @@
-from pydantic import BaseModel
+from pydantic import BaseModel, model_validator
 from fastapi import UploadFile
+from typing import Optional
 
 class RequestSearchObject(BaseModel):
     type: str
@@ -9,7 +10,15 @@ class RequestVideoObject(BaseModel):
     videoId: str
     title: str
     timestamp: str
-    videoData: bytes
+    # either the raw upload or a path to it already on disk
+    videoData: Optional[bytes] = None
+    videoPath: Optional[str] = None
+
+    @model_validator(mode="after")
+    def check_video_source(self):
+        if (self.videoData is None) == (self.videoPath is None):
+            raise ValueError("Exactly one of videoData or videoPath must be set.")
+        return self
 
 # we're transcript + tags generation
 '''
@@ -1,142 +1,223 @@
 import ffmpeg 
 import numpy as np
+import os
+import subprocess
 import tempfile
-from io import BytesIO
-from backend.preprocessing.transcript_processor import TranscriptProcessor
+from turbojpeg import TurboJPEG, TJPF_RGB
+from backend.preprocessing.transcript_processor import get_transcript_processor
 from backend.objects.RequestObjects import RequestVideoObject
+
+CLIP_INPUT_SIZE = 224
+
 class ProcessingManager():
     def __init__(self,requestVideoObject:RequestVideoObject):
-        video_bytes = requestVideoObject.videoData
         self.requestVideoObject = requestVideoObject
-        self.video_bytes = video_bytes
+        self.jpeg = TurboJPEG()
+
+        # model_construct skips RequestVideoObject's validator, so check the source here too
+        if (requestVideoObject.videoData is None) == (requestVideoObject.videoPath is None):
+            raise ValueError("Exactly one of videoData or videoPath must be set.")
+
+        # mp4 needs a seekable input, so ffmpeg reads the upload from disk; write it
+        # once here unless the caller already streamed it to a file
+        if requestVideoObject.videoPath is not None:
+            self.video_file = None
+            self.video_path = requestVideoObject.videoPath
+        else:
+            self.video_file = tempfile.NamedTemporaryFile(suffix=".mp4")
+            self.video_file.write(requestVideoObject.videoData)
+            self.video_file.flush()
+            self.video_path = self.video_file.name
         
-        # Extract metadata and audio
-        self.set_dimensions_from_metadata(video_bytes)
-        self.audio_bytes = self.extract_audio(video_bytes)
+        # Extract metadata; audio is decoded alongside the frames in split_video_to_frames
+        self.set_dimensions_from_metadata()
+        self.audio_bytes = None
+
+    def close(self):
+        if self.video_file is not None:
+            self.video_file.close()
     
-    def set_dimensions_from_metadata(self, video_bytes: bytes):
-        with tempfile.NamedTemporaryFile(suffix=".mp4") as tmp:
-            tmp.write(video_bytes)
-            tmp.flush()
-            
-            probe = ffmpeg.probe(tmp.name)
-            video_stream = next((stream for stream in probe['streams'] if stream['codec_type'] == 'video'), None)
-            
-            if video_stream is None:
-                raise ValueError("No video stream found in the provided data.")
-
-            # Store original dimensions (before rotation) for raw frame extraction
-            self.original_width = int(video_stream['width'])
-            self.original_height = int(video_stream['height'])
-
-            # Detect rotation from metadata
-            self.rotation = 0
-            if 'tags' in video_stream and 'rotate' in video_stream['tags']:
-                self.rotation = int(video_stream['tags']['rotate'])
-            # Also check side_data for rotation (newer ffmpeg)
-            if 'side_data_list' in video_stream:
-                for side_data in video_stream['side_data_list']:
-                    if side_data.get('side_data_type') == 'Display Matrix' and 'rotation' in side_data:
-                        self.rotation = int(side_data['rotation'])
-            
-            # Final dimensions after rotation is applied
-            if self.rotation in [90, 270, -90, -270]:
-                self.width, self.height = self.original_height, self.original_width
-            else:
-                self.width, self.height = self.original_width, self.original_height
+    def set_dimensions_from_metadata(self):
+        probe = ffmpeg.probe(self.video_path)
+        video_stream = next((stream for stream in probe['streams'] if stream['codec_type'] == 'video'), None)
+        
+        if video_stream is None:
+            raise ValueError("No video stream found in the provided data.")
+        self.has_audio = any(stream['codec_type'] == 'audio' for stream in probe['streams'])
+        self.duration = float(probe.get('format', {}).get('duration') or video_stream.get('duration') or 0)
+
+        # Store original dimensions (before rotation) for raw frame extraction
+        self.original_width = int(video_stream['width'])
+        self.original_height = int(video_stream['height'])
+
+        # Detect rotation from metadata
+        self.rotation = 0
+        if 'tags' in video_stream and 'rotate' in video_stream['tags']:
+            self.rotation = int(video_stream['tags']['rotate'])
+        # Also check side_data for rotation (newer ffmpeg)
+        if 'side_data_list' in video_stream:
+            for side_data in video_stream['side_data_list']:
+                if side_data.get('side_data_type') == 'Display Matrix' and 'rotation' in side_data:
+                    self.rotation = int(side_data['rotation'])
+        
+        # Final dimensions after rotation is applied
+        if self.rotation in [90, 270, -90, -270]:
+            self.width, self.height = self.original_height, self.original_width
+        else:
+            self.width, self.height = self.original_width, self.original_height
+        
+        print(f"📹 Video: {self.original_width}x{self.original_height}, rotation={self.rotation}, final={self.width}x{self.height}")
             
-            print(f"📹 Video: {self.original_width}x{self.original_height}, rotation={self.rotation}, final={self.width}x{self.height}")
-                
-    def extract_audio(self, video_bytes: bytes):
-        with tempfile.NamedTemporaryFile(suffix=".mp4") as tmp:
-            tmp.write(video_bytes)
-            tmp.flush()
-
-            out, _ = (
-                ffmpeg
-                .input(tmp.name)
-                .output('pipe:1', format='wav')
-                .run(capture_stdout=True, capture_stderr=True)
-            )
+    def extract_audio(self):
+        out, _ = (
+            ffmpeg
+            .input(self.video_path)
+            .output('pipe:1', format='wav')
+            .run(capture_stdout=True, capture_stderr=True)
+        )
         return out
 
     def split_video_to_frames(self, fps):
         """Extract frames from video, properly handling rotation.
         
-        Returns PIL Images that CLIP can directly preprocess.
+        The audio track is decoded in the same ffmpeg pass and kept in
+        self.audio_bytes for create_transcript_from_audio.
+
+        Returns one contiguous (N, 224, 224, 3) uint8 RGB array of letterboxed frames.
         """
-        from PIL import Image
+        # Decode frames straight into preallocated arrays instead of one object per frame;
+        # the first chunk is sized from the duration, overflow grows 128 frames at a time
+        expected_frames = int(self.duration * fps) + 1 if self.duration else 128
+        chunks = []
+        filled = 0
+
+        for frame in self.iter_video_frames(fps):
+            if not chunks or filled == len(chunks[-1]):
+                size = 128 if chunks else expected_frames
+                chunks.append(np.empty((size, *frame.shape), dtype=np.uint8))
+                filled = 0
+            chunks[-1][filled] = frame
+            filled += 1
+        
+        if chunks:
+            chunks[-1] = chunks[-1][:filled]
+            frames = chunks[0] if len(chunks) == 1 else np.concatenate(chunks)
+        else:
+            frames = np.empty((0, 0, 0, 3), dtype=np.uint8)
         
-        with tempfile.NamedTemporaryFile(suffix=".mp4") as tmp:
-            tmp.write(self.video_bytes)
-            tmp.flush()
+        print(f"📹 Extracted {len(frames)} frames at {fps} fps")
+        return frames
 
-            # Build ffmpeg pipeline
-            stream = ffmpeg.input(tmp.name)
-            
-            # Apply rotation correction based on metadata
-            # This ensures raw output matches the intended orientation
-            if self.rotation == 90 or self.rotation == -270:
-                stream = stream.filter('transpose', 1)  # 90 clockwise
-            elif self.rotation == 180 or self.rotation == -180:
-                stream = stream.filter('transpose', 1).filter('transpose', 1)  # 180
-            elif self.rotation == 270 or self.rotation == -90:
-                stream = stream.filter('transpose', 2)  # 90 counter-clockwise
-            
-            # Sample at target fps
-            stream = stream.filter('fps', fps=fps)
-            
-            # Scale to max 320 on the longer side, preserving aspect ratio
-            # Use scale2ref or just scale with force_original_aspect_ratio
-            stream = stream.filter('scale', 
-                                   'min(320,iw)', 'min(320,ih)', 
-                                   force_original_aspect_ratio='decrease')
-            
-            # Output as JPEG images (avoids dimension calculation issues)
-            process = (
-                stream
-                .output('pipe:1', format='image2pipe', vcodec='mjpeg', q=2)
-                .run_async(pipe_stdout=True, pipe_stderr=True)
-            )
-
-            # Read JPEG frames from pipe
-            frames = []
-            jpeg_data = b''
-            
-            while True:
-                chunk = process.stdout.read(4096)
-                if not chunk:
-                    break
-                jpeg_data += chunk
-                
-                # Find JPEG boundaries (FFD8 start, FFD9 end)
+    def iter_video_frames(self, fps):
+        """Yield (224, 224, 3) uint8 RGB frames one at a time as ffmpeg decodes them.
+
+        Only the frames the caller still holds stay in memory. self.audio_bytes is
+        filled in once the generator is exhausted.
+        """
+        # Build ffmpeg pipeline, decoding on NVDEC/VideoToolbox/QSV when available
+        # (falls back to software decode; FFMPEG_HWACCEL=none disables it)
+        source = ffmpeg.input(self.video_path, hwaccel=os.getenv("FFMPEG_HWACCEL", "auto"))
+        stream = source.video
+        
+        # Apply rotation correction based on metadata
+        # This ensures raw output matches the intended orientation
+        if self.rotation == 90 or self.rotation == -270:
+            stream = stream.filter('transpose', 1)  # 90 clockwise
+        elif self.rotation == 180 or self.rotation == -180:
+            stream = stream.filter('transpose', 1).filter('transpose', 1)  # 180
+        elif self.rotation == 270 or self.rotation == -90:
+            stream = stream.filter('transpose', 2)  # 90 counter-clockwise
+        
+        # Sample at target fps
+        stream = stream.filter('fps', fps=fps)
+        
+        # Letterbox to CLIP's input size here so frames never exist at full resolution
+        # outside the decoder, and CLIP's resize/crop becomes a no-op
+        stream = stream.filter('scale', 
+                               CLIP_INPUT_SIZE, CLIP_INPUT_SIZE, 
+                               force_original_aspect_ratio='decrease')
+        stream = stream.filter('pad', CLIP_INPUT_SIZE, CLIP_INPUT_SIZE, '(ow-iw)/2', '(oh-ih)/2')
+        
+        # Output as JPEG images (avoids dimension calculation issues), pinned to 4:2:0
+        # chroma so a 4:4:4 source can't double the bytes pushed through the pipe
+        outputs = [stream.output('pipe:1', format='image2pipe', vcodec='mjpeg', q=2, pix_fmt='yuvj420p')]
+
+        # Write the audio track to a wav file from the same decode
+        audio_file = tempfile.NamedTemporaryFile(suffix=".wav")
+        if self.has_audio:
+            outputs.append(source.audio.output(audio_file.name, format='wav'))
+
+        # stdout is drained at CLIP's pace, so ffmpeg can outlive a full stderr pipe; send only
+        # errors to a temp file instead of piping progress stats nobody reads
+        stderr_file = tempfile.TemporaryFile()
+        args = (
+            ffmpeg
+            .merge_outputs(*outputs)
+            .global_args('-nostats', '-loglevel', 'error')
+            .overwrite_output()
+            .compile()
+        )
+        process = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=stderr_file)
+
+        # Read JPEG frames from pipe into a growable buffer, tracking how much has been
+        # consumed instead of re-slicing the data on every frame
+        jpeg_data = bytearray()
+        read_pos = 0
+        
+        with audio_file, stderr_file:
+            try:
                 while True:
-                    start = jpeg_data.find(b'\xff\xd8')
-                    if start == -1:
-                        break
-                    end = jpeg_data.find(b'\xff\xd9', start + 2)
-                    if end == -1:
+                    chunk = process.stdout.read(1 << 16)
+                    if not chunk:
                         break
+                    jpeg_data.extend(chunk)
                     
-                    # Extract complete JPEG
-                    jpeg_bytes = jpeg_data[start:end + 2]
-                    jpeg_data = jpeg_data[end + 2:]
-                    
-                    try:
-                        img = Image.open(BytesIO(jpeg_bytes))
-                        frames.append(img.copy())  # Copy to detach from buffer
-                        img.close()
-                    except Exception as e:
-                        print(f"⚠️ Failed to decode frame: {e}")
-
-            process.wait()
-            
-        print(f"📹 Extracted {len(frames)} frames at {fps} fps")
-        return frames
+                    # Find JPEG boundaries (FFD8 start, FFD9 end)
+                    while True:
+                        start = jpeg_data.find(b'\xff\xd8', read_pos)
+                        if start == -1:
+                            break
+                        end = jpeg_data.find(b'\xff\xd9', start + 2)
+                        if end == -1:
+                            break
+                        
+                        # Extract complete JPEG
+                        jpeg_bytes = jpeg_data[start:end + 2]
+                        read_pos = end + 2
+                        
+                        try:
+                            frame = self.jpeg.decode(jpeg_bytes, pixel_format=TJPF_RGB)
+                        except Exception as e:
+                            print(f"⚠️ Failed to decode frame: {e}")
+                            continue
+                        yield frame
+
+                    # Drop the consumed prefix only once it is large, so compaction stays amortized
+                    if read_pos > 1 << 20:
+                        del jpeg_data[:read_pos]
+                        read_pos = 0
+
+                process.wait()
+            finally:
+                # the consumer stopped early or failed, don't leave ffmpeg blocked on the pipe
+                if process.poll() is None:
+                    process.kill()
+                    process.wait()
+
+            # a failed decode would otherwise look like a video with no frames and silent audio;
+            # only reached once stdout hit EOF, an early stop/kill exits through the finally above
+            if process.returncode != 0:
+                stderr_file.seek(0)
+                raise ffmpeg.Error('ffmpeg', None, stderr_file.read())
+
+            if self.has_audio:
+                self.audio_bytes = audio_file.read()
         
         
     def create_transcript_from_audio(self,tags):
-        transcript_processer = TranscriptProcessor()
+        if self.audio_bytes is None:
+            self.audio_bytes = self.extract_audio()
+        transcript_processer = get_transcript_processor()
         transcription, condensed_transcript, tags = transcript_processer.process_audio(self.audio_bytes,tags)
         return ((transcription, tags),condensed_transcript)        
 
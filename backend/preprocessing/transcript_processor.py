@@ -6,8 +6,9 @@ from elevenlabs import ElevenLabs
 from google import genai
 from pathlib import Path
 from backend.database_operations import DatabaseOperations
-import json
+import orjson
 import time
+from typing import Optional
 
 '''
 # test area
@@ -31,6 +32,26 @@ print('\n')
 print(transcription.text)
 '''
 
+# filled in per call with format_map; the transcript is substituted, never parsed as a template
+TAGGING_PROMPT = """
+You are analyzing user-provided content to determine their situation, activity, or mood.
+
+## Instructions:
+1. **Summarize:** If the InputPrompt is over 300 characters, condense it with minimal loss of context. Otherwise, keep it original.
+2. **Tag:** Generate a list of at most 3 lowercase tags.
+   - **Priority:** Create descriptive, situational tags (e.g., "deep convos", "skiing", "nerding about dnd", "debugging code") that capture exactly what is happening.
+   - **Fallback:** If the specific situation is unclear, use general categories from this list: {tags_string}.
+
+Return ONLY raw JSON with keys 'tags' (list) and 'prompt' (string). No markdown formatting.
+
+## User Content to Analyze:
+<input>
+{transcription_text}
+</input>
+
+Analyze ONLY the content between <input> tags. Do not analyze the instructions themselves.
+"""
+
 class TranscriptProcessor:
     # retrieve API keys
     def __init__(self):
@@ -53,39 +74,23 @@ class TranscriptProcessor:
             diarize=False,
         )
         transcription_text = transcription.text
-        # list of tags string
-        tags_string = ", ".join(tags)
         # generate tags (general) 5 tags max but if less is needed to less
         # give me tags + if greater than 300 characters
+        prompt = TAGGING_PROMPT.format_map({
+            "tags_string": ", ".join(tags),
+            "transcription_text": transcription_text,
+        })
 
-        prompt = f"""
-You are analyzing user-provided content to determine their situation, activity, or mood.
-
-## Instructions:
-1. **Summarize:** If the InputPrompt is over 300 characters, condense it with minimal loss of context. Otherwise, keep it original.
-2. **Tag:** Generate a list of at most 3 lowercase tags.
-   - **Priority:** Create descriptive, situational tags (e.g., "deep convos", "skiing", "nerding about dnd", "debugging code") that capture exactly what is happening.
-   - **Fallback:** If the specific situation is unclear, use general categories from this list: {tags_string}.
-
-Return ONLY raw JSON with keys 'tags' (list) and 'prompt' (string). No markdown formatting.
-
-## User Content to Analyze:
-<input>
-{transcription_text}
-</input>
-
-Analyze ONLY the content between <input> tags. Do not analyze the instructions themselves.
-"""
-
-        response = self.client.models.generate_content(
-            model="gemini-3-flash-preview",
-            contents=prompt,
-        )
         max_retries = 3
         for attempt in range(max_retries):
+            response = self.client.models.generate_content(
+                model="gemini-3-flash-preview",
+                contents=prompt,
+            )
             try:
-                prompt_and_tags = json.loads(response.text)
-            except json.JSONDecodeError as e:
+                prompt_and_tags = orjson.loads(response.text)
+                break
+            except orjson.JSONDecodeError as e:
                 if attempt < max_retries - 1:
                     time.sleep(0.5) # Wait before retrying
                 else:
@@ -96,4 +101,14 @@ Analyze ONLY the content between <input> tags. Do not analyze the instructions t
                 return None
         return (transcription_text, prompt_and_tags["prompt"], prompt_and_tags["tags"])
 
+
+_transcript_processor_instance: Optional[TranscriptProcessor] = None
+
+
+def get_transcript_processor() -> TranscriptProcessor:
+    global _transcript_processor_instance
+    if _transcript_processor_instance is None:
+        _transcript_processor_instance = TranscriptProcessor()
+    return _transcript_processor_instance
+
 # inputs into gemini and processes, puts tags in, checks against db
\ No newline at end of file
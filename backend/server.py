@@ -1,22 +1,33 @@
 # local server endpoints using fastapi
-from fastapi import FastAPI,Form,File,UploadFile
+from fastapi import FastAPI,Form,File,UploadFile,Depends
 from fastapi.middleware.cors import CORSMiddleware
 from datetime import datetime
 from backend.objects.RequestObjects import RequestSearchObject, RequestVideoObject
 from backend.objects.ResponseObjects import ResponseTagsObject, ResponseVideoObject
-from backend.database_operations import DatabaseOperations
+from backend.database_operations import DatabaseOperations, get_db, close_db
 from backend.preprocessing.processing_manager import ProcessingManager
 from backend.vectorizer import Vectorizer, get_vectorizer
 import uvicorn
 import numpy as np
+import asyncio
+import os
+import tempfile
+import shutil
 app = FastAPI()
 
+UPLOAD_CHUNK_SIZE = 1 << 20
+
 # Preload the vectorizer model at startup so first search is fast
 @app.on_event("startup")
 async def startup_event():
     print("🚀 Preloading CLIP model...")
-    get_vectorizer()  # This caches the model
+    get_vectorizer().compile()  # This caches the model and compiles it once
     print("✅ CLIP model ready!")
+    get_db()  # Open the shared Milvus + sqlite connections once
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    close_db()
 
 # Allow CORS for iOS app
 app.add_middleware(
@@ -36,148 +47,142 @@ def health_check():
         "timestamp": datetime.utcnow().isoformat()
     }
 
+def save_upload(upload: UploadFile) -> str:
+    with tempfile.NamedTemporaryFile(delete=False, suffix=".mp4") as tmp:
+        try:
+            shutil.copyfileobj(upload.file, tmp, UPLOAD_CHUNK_SIZE)
+        except BaseException:
+            # the caller never gets the path, so a partial file would never be removed
+            tmp.close()
+            os.remove(tmp.name)
+            raise
+        return tmp.name
+
 # upload video
 @app.post("/api/videos")
 async def create_video(
     videoId: str = Form(...),
     title: str = Form(...),
     timestamp: str = Form(...),
-    videoData: UploadFile = File(...)
+    videoData: UploadFile = File(...),
+    db: DatabaseOperations = Depends(get_db)
 ):
-    video_bytes = await videoData.read()
+    # stream the upload to disk in 1 MB chunks instead of holding the whole video in memory;
+    # the whole copy runs in one worker thread rather than a thread hop per chunk plus
+    # blocking writes on the event loop
+    video_path = await asyncio.to_thread(save_upload, videoData)
 
-    # Create your RequestVideoObject instance
-    video = RequestVideoObject(
+    # Create your RequestVideoObject instance; the form fields are already validated by
+    # FastAPI, so skip pydantic validation
+    video = RequestVideoObject.model_construct(
         videoId=videoId,
         title=title,
         timestamp=timestamp,
-        videoData=video_bytes
+        videoPath=video_path
     )
-    pm = ProcessingManager(video)
-    db = DatabaseOperations()
+    pm = None
     try:
+        # ffmpeg probing and frame decoding block, so keep them off the event loop
+        pm = await asyncio.to_thread(ProcessingManager, video)
         vectorizer = get_vectorizer()  # Use cached singleton
-        # preprocessing
-        tags = db.query_tags_table_get_tags()
-        ((transcription, tags), condensed_transcript) = pm.create_transcript_from_audio(tags)
+        # preprocessing, frames first since the same ffmpeg pass extracts the audio; frames
+        # are encoded batch by batch as they are decoded, so only embeddings are kept
+        image_vectors = await asyncio.to_thread(list, vectorizer.encode_images_iter(pm.iter_video_frames(3)))
+        # transcription and sqlite calls block too, run each in a worker thread
+        tags = await asyncio.to_thread(db.query_tags_table_get_tags)
+        ((transcription, tags), condensed_transcript) = await asyncio.to_thread(pm.create_transcript_from_audio, tags)
         # video _ tags table insertion
         
-        db.insert_video_table(video.videoId, video.title, transcription, video.timestamp)
-        for tag in tags:
-            db.insert_tags_table(tag, video.videoId)
+        await asyncio.to_thread(db.insert_video_table, video.videoId, video.title, transcription, video.timestamp)
+        await asyncio.to_thread(db.insert_tags_table_many, [(tag, video.videoId) for tag in tags])
         # vectorizing table insertion
-        frames = pm.split_video_to_frames(3)
-        image_vectors = vectorizer.encode_images(frames)
-        
-        for image_vector in image_vectors:
-            db.insert_vector_table(image_vector,videoId)
-            
-        transcription_vector = vectorizer.encode_text(condensed_transcript)
-        db.insert_vector_table(transcription_vector,videoId)
-        db.close()
+        transcription_vector = await asyncio.to_thread(vectorizer.encode_text, condensed_transcript)
+        # frame and transcript embeddings go to Milvus as a single batch
+        await db.insert_vector_table_batch(np.vstack([*image_vectors, transcription_vector]), videoId)
         return {"message": "Item created"}
     finally:
-        db.close()
+        if pm is not None:
+            pm.close()
+        os.remove(video_path)
+
+def build_video_objects(videos, db: DatabaseOperations):
+    # one tags query for the whole page instead of one per video
+    tags_by_video = db.query_tags_by_video_ids([video[0] for video in videos])
+    return [
+        ResponseVideoObject(
+            videoId=id,
+            title=title,
+            transcript=transcript,
+            timestamp=timestamp,
+            tags=tags_by_video.get(id, [])
+        )
+        for (id, title, transcript, timestamp) in videos
+    ]
 
 # get all videos, PAGINATION NOT IMPLEMENTED YET
 @app.get("/api/videos")
-def get_videos(limit: int = 50, offset: int = 0):
-    db = DatabaseOperations()
-    try:
-        all_videos = db.query_video_table_all() # need this to be in the proper format
-        # format: [(id, title, transcript, timestamp), (), ()]
-        all_video_objects = []
-        for (id, title, transcript, timestamp) in all_videos:
-            tags = db.query_tags_table_by_video_id(id)
-            video_object = ResponseVideoObject(
-                videoId=id,
-                title=title,
-                transcript=transcript,
-                timestamp=timestamp,
-                tags=tags
-            )
-            all_video_objects.append(video_object)
-        db.close()
-        return {"success": True, "result": all_video_objects}
-    finally:
-        db.close()
+def get_videos(limit: int = 50, offset: int = 0, db: DatabaseOperations = Depends(get_db)):
+    all_videos = db.query_video_table_all() # need this to be in the proper format
+    # format: [(id, title, transcript, timestamp), (), ()]
+    all_video_objects = build_video_objects(all_videos, db)
+    return {"success": True, "result": all_video_objects}
 
 
 @app.get("/api/tags")
-def get_videos(limit: int = 50, offset: int = 0):
-    db = DatabaseOperations()
-    try:
-        all_tags = db.query_tags_table_get_tags() 
-        db.close()
-        return {"success": True, "result": all_tags}
-    finally:
-        db.close()
+def get_tags(limit: int = 50, offset: int = 0, db: DatabaseOperations = Depends(get_db)):
+    all_tags = db.query_tags_table_get_tags() 
+    return {"success": True, "result": all_tags}
 
 # retrieve full metadata + transcript for a specific video
 @app.get("/api/videos/{videoId}")
-def get_video(videoId):
-    db = DatabaseOperations()
-    try:
-        id, title, transcript, timestamp = db.query_video_table(videoId)
-        tags = db.query_tags_table_by_video_id(id)
-        result = ResponseVideoObject(
-            videoId=id,
-            title=title,
-            transcript=transcript,
-            timestamp=timestamp,
-            tags=tags
-        )
-        db.close()
-        return {"success": True, "result": result}
-    finally:
-        db.close()
+def get_video(videoId, db: DatabaseOperations = Depends(get_db)):
+    id, title, transcript, timestamp = db.query_video_table(videoId)
+    tags = db.query_tags_table_by_video_id(id)
+    result = ResponseVideoObject(
+        videoId=id,
+        title=title,
+        transcript=transcript,
+        timestamp=timestamp,
+        tags=tags
+    )
+    return {"success": True, "result": result}
 
 @app.get("/api/search/")
-def search(type, input):
-    db = DatabaseOperations()
-    try:
-        if type == "tag":
-            videos = db.get_videos_from_tags(input)
-            video_objects = []
-            for (id, title, transcript, timestamp) in videos:
-                tags = db.query_tags_table_by_video_id(id)
-                video_object = ResponseVideoObject(
-                    videoId=id,
-                    title=title,
-                    transcript=transcript,
-                    timestamp=timestamp,
-                    tags=tags
-                )
-                video_objects.append(video_object)
-            return video_objects
-        else:
-            vectorizer = get_vectorizer()
-            encoded_vector = vectorizer.encode_text(input)
-            print(f"🔍 Search query: '{input}'")
-            print(f"🔍 Query vector norm: {np.linalg.norm(encoded_vector):.4f}")
-            
-            result = db.search_vector_table(encoded_vector)
-            
-            # Log search results with distances
-            if result and result[0]:
-                print(f"🔍 Found {len(result[0])} results:")
-                for i, item in enumerate(result[0][:5]):
-                    dist = item.get('distance', 'N/A')
-                    vid = item['entity']['video_id']
-                    print(f"   {i+1}. {vid[:30]}... (dist: {dist})")
-            
-            seen = set()
-            unique_video_ids = [
-                item['entity']['video_id'] 
-                for item in result[0] 
-                if item['entity']['video_id'] not in seen and not seen.add(item['entity']['video_id'])
-            ][:3]
-            
-            video_objs = []
-            for video_id in unique_video_ids:
-                video_objs.append(get_video(video_id)["result"])
-            return video_objs
-    finally:
-        db.close()
+def search(type, input, db: DatabaseOperations = Depends(get_db)):
+    if type == "tag":
+        videos = db.get_videos_from_tags(input)
+        return build_video_objects(videos, db)
+    else:
+        vectorizer = get_vectorizer()
+        encoded_vector = vectorizer.encode_text(input)
+        print(f"🔍 Search query: '{input}'")
+        print(f"🔍 Query vector norm: {np.linalg.norm(encoded_vector):.4f}")
+        
+        result = db.search_vector_table(encoded_vector)
+        
+        # Log search results with distances
+        if result and result[0]:
+            print(f"🔍 Found {len(result[0])} results:")
+            for i, item in enumerate(result[0][:5]):
+                dist = item.get('distance', 'N/A')
+                vid = item['entity']['video_id']
+                print(f"   {i+1}. {vid[:30]}... (dist: {dist})")
+        
+        # top 3 distinct videos, stop scanning as soon as they're found
+        seen = set()
+        unique_video_ids = []
+        for item in result[0]:
+            video_id = item['entity']['video_id']
+            if video_id in seen:
+                continue
+            seen.add(video_id)
+            unique_video_ids.append(video_id)
+            if len(unique_video_ids) == 3:
+                break
+        
+        # fetch all hits in two queries, then restore the similarity ranking
+        videos_by_id = {video[0]: video for video in db.query_videos_by_ids(unique_video_ids)}
+        videos = [videos_by_id[video_id] for video_id in unique_video_ids if video_id in videos_by_id]
+        return build_video_objects(videos, db)
 if __name__ == "__main__":
     uvicorn.run(app, port=8000)
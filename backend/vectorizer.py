@@ -1,87 +1,248 @@
 import torch
+import torch.nn.functional as F
 import clip
 import numpy as np
 from PIL import Image
-from typing import List, Union, Optional
+from typing import Iterable, Iterator, List, Union, Optional
 from io import BytesIO
 import base64
+import contextlib
+import functools
+import itertools
+import os
+from pathlib import Path
+
+try:
+    import fcntl
+except ImportError:  # Windows, cache writes just aren't locked
+    fcntl = None
+
+IMAGE_BATCH_SIZE = 32
+TEXT_CACHE_SIZE = 1024
+# longer texts are cut before tokenizing, CLIP only sees 77 tokens anyway
+MAX_TEXT_CHARS = 300
+# CLIP's normalization constants, same as clip.load's preprocess transform
+CLIP_MEAN = (0.48145466, 0.4578275, 0.40821073)
+CLIP_STD = (0.26862954, 0.26130258, 0.27577711)
+# built, fp16-cast models are pickled here so restarts skip clip.load's build_model; the cache is
+# unpickled as a full module, so it must live somewhere only this user can write (not /tmp)
+MODEL_CACHE_DIR = Path(os.getenv("CLIP_MODEL_CACHE_DIR", Path.home() / ".cache" / "clip"))
+# CLIP_TORCH_COMPILE=0 skips compiling the towers, e.g. to keep dev restarts fast
+TORCH_COMPILE = os.getenv("CLIP_TORCH_COMPILE", "1") == "1"
+
+
+def _decode_bytes(image: bytes) -> Image.Image:
+    return Image.open(BytesIO(image)).convert("RGB")
+
+
+def _decode_b64(image: str) -> Image.Image:
+    return Image.open(BytesIO(base64.b64decode(image))).convert("RGB")
+
+
+def _decode_ndarray(image: np.ndarray) -> Image.Image:
+    return Image.fromarray(image).convert("RGB")
+
+
+def _decode_pil(image: Image.Image) -> Image.Image:
+    return image.convert("RGB")
+
+
+# keyed on the exact type so the common case is one dict lookup instead of an isinstance chain
+_DECODERS = {
+    bytes: _decode_bytes,
+    str: _decode_b64,
+    np.ndarray: _decode_ndarray,
+    Image.Image: _decode_pil,
+}
+
+
+def _to_pil(image) -> Image.Image:
+    try:
+        decoder = _DECODERS[type(image)]
+    except KeyError:
+        # subclasses such as JpegImageFile; remember the match so the next one is a plain lookup
+        decoder = next((d for base, d in list(_DECODERS.items()) if isinstance(image, base)), None)
+        if decoder is None:
+            raise ValueError(f"Unsupported image type: {type(image)}")
+        _DECODERS[type(image)] = decoder
+    return decoder(image)
 
 
 class Vectorizer:
     def __init__(self, model_name: str = "ViT-B/32", device: Optional[str] = None):
         self.device = device or ("cuda" if torch.cuda.is_available() else "cpu")
-        self.model, self.preprocess = clip.load(model_name, device=self.device)
-        self.model.eval()
+        self.use_fp16 = self.device.startswith("cuda")
+        self.model = self._load_model(model_name).eval()
+        self.preprocess = clip.clip._transform(self.model.visual.input_resolution)
         self.embedding_dim = 512
+        self.input_resolution = self.model.visual.input_resolution
+        self._mean = torch.tensor(CLIP_MEAN, device=self.device).view(1, 3, 1, 1)
+        self._std = torch.tensor(CLIP_STD, device=self.device).view(1, 3, 1, 1)
+        # search queries repeat a lot, the cache lives on the instance so it never mixes models
+        self._cached_encode_text = functools.lru_cache(maxsize=TEXT_CACHE_SIZE)(self._encode_single_text)
+        self._compiled = False
+
+    def _load_model(self, model_name: str) -> torch.nn.Module:
+        MODEL_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        cache_path = MODEL_CACHE_DIR / f"clip_{model_name.replace('/', '_')}_{self.device}.pt"
+        # several uvicorn workers may start at once, only one of them should build the cache
+        with open(cache_path.with_suffix(".lock"), "w") as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            if cache_path.exists():
+                try:
+                    return torch.load(cache_path, map_location=self.device, weights_only=False)
+                except Exception as e:
+                    # e.g. pickled by an older torch/clip, rebuild it below
+                    print(f"⚠️ Ignoring unreadable CLIP model cache {cache_path}: {e}")
+
+            model, _ = clip.load(model_name, device=self.device)
+            if self.use_fp16:
+                model = model.half()
+            tmp_path = cache_path.with_suffix(".tmp")
+            torch.save(model, tmp_path)
+            os.replace(tmp_path, cache_path)
+            return model
+
+    def compile(self):
+        # fused inductor kernels only pay off on GPU, and the CPU backend needs a C++ toolchain
+        if self._compiled or not TORCH_COMPILE or not self.device.startswith("cuda") or not hasattr(torch, "compile"):
+            return
+        self._compiled = True
+        # compile the towers rather than the CLIP module, encode_image/encode_text call into them;
+        # inputs are always (N, 3, 224, 224) and (N, 77) so shapes can stay static
+        # default mode, not reduce-overhead: CUDA graph trees are thread-local, and the towers are
+        # called from to_thread workers and the threadpool, concurrently, not from this thread
+        self.model.visual = torch.compile(self.model.visual, dynamic=False)
+        self.model.transformer = torch.compile(self.model.transformer, dynamic=False)
+
+        # the first call per input shape is the slow one, pay it here instead of on the first
+        # request; images are always padded to a full batch, search queries are a single text
+        size = self.input_resolution
+        self.encode_images(np.zeros((IMAGE_BATCH_SIZE, size, size, 3), dtype=np.uint8))
+        self._encode_texts(["warmup"])
+
+    def _autocast(self):
+        # tensor cores only kick in for fp16 on GPU; CPU inference stays fp32
+        if self.use_fp16:
+            return torch.autocast(device_type="cuda", dtype=torch.float16)
+        return contextlib.nullcontext()
+
+    def _to_device(self, x: torch.Tensor) -> torch.Tensor:
+        # page-locked host memory lets the host-to-device copy run asynchronously
+        if self.device.startswith("cuda"):
+            if not x.is_pinned():
+                x = x.pin_memory()
+            return x.to(self.device, non_blocking=True)
+        return x.to(self.device)
+
+    # batched, on-device version of self.preprocess (resize short side, center crop,
+    # normalize) for (N, H, W, 3) uint8 RGB frames
+    def _preprocess_frames(self, frames: np.ndarray) -> torch.Tensor:
+        size = self.input_resolution
+        x = self._to_device(torch.from_numpy(np.ascontiguousarray(frames)))
+        x = x.permute(0, 3, 1, 2).float().div_(255.0)
+
+        h, w = x.shape[-2:]
+        if min(h, w) != size:
+            if h < w:
+                new_h, new_w = size, int(size * w / h)
+            else:
+                new_h, new_w = int(size * h / w), size
+            x = F.interpolate(x, size=(new_h, new_w), mode="bicubic", align_corners=False, antialias=True)
+            x = x.clamp_(0.0, 1.0)
+            h, w = new_h, new_w
+
+        top = int(round((h - size) / 2.0))
+        left = int(round((w - size) / 2.0))
+        x = x[:, :, top:top + size, left:left + size]
+        return ((x - self._mean) / self._std).to(self.model.dtype)
         
     @staticmethod
     def available_models() -> List[str]:
         return clip.available_models()
     
-    def encode_image(self, image: Union[Image.Image, bytes, str]) -> np.ndarray:
-        if isinstance(image, bytes):
-            image = Image.open(BytesIO(image)).convert("RGB")
-        elif isinstance(image, str):
-            image_bytes = base64.b64decode(image)
-            image = Image.open(BytesIO(image_bytes)).convert("RGB")
-        elif isinstance(image, Image.Image):
-            image = image.convert("RGB")
-        else:
-            raise ValueError(f"Unsupported image type: {type(image)}")
+    def encode_image(self, image: Union[Image.Image, np.ndarray, bytes, str]) -> np.ndarray:
+        image = _to_pil(image)
         
-        image_input = self.preprocess(image).unsqueeze(0).to(self.device)
+        image_input = self.preprocess(image).unsqueeze(0).to(self.device, dtype=self.model.dtype)
         
-        with torch.no_grad():
-            image_features = self.model.encode_image(image_input)
-            image_features = image_features / image_features.norm(dim=-1, keepdim=True)
+        with torch.inference_mode(), self._autocast():
+            image_features = self._forward_images(image_input)
             
-        return image_features.cpu().numpy().flatten()
+        return image_features.float().cpu().numpy().ravel()
     
+    def _forward_images(self, image_batch: torch.Tensor) -> torch.Tensor:
+        n = len(image_batch)
+        # the compiled visual tower is specialized to IMAGE_BATCH_SIZE rows, so pad the last
+        # micro-batch of an upload (and single images) instead of recompiling per size
+        if self._compiled and n < IMAGE_BATCH_SIZE:
+            padding = image_batch.new_zeros((IMAGE_BATCH_SIZE - n, *image_batch.shape[1:]))
+            image_batch = torch.cat([image_batch, padding])
+        image_features = self.model.encode_image(image_batch)[:n]
+        return image_features / image_features.norm(dim=-1, keepdim=True)
+
     def encode_images(self, images):
-        if not images:
+        if len(images) == 0:
             return np.empty((0, 512), dtype=np.float32)
 
-        processed_images = []
-
-        for img in images:
-            if isinstance(img, np.ndarray):
-                pil_img = Image.fromarray(img).convert("RGB")
-            elif isinstance(img, bytes):
-                pil_img = Image.open(BytesIO(img)).convert("RGB")
-            elif isinstance(img, str):
-                pil_img = Image.open(BytesIO(base64.b64decode(img))).convert("RGB")
-            elif isinstance(img, Image.Image):
-                pil_img = img.convert("RGB")
+        # encode in fixed-size micro-batches so long videos don't exhaust GPU memory; features
+        # are written into one float32 output on the device, so copies and forward passes
+        # queue without a sync and there is no concatenate/cast copy at the end
+        features = torch.empty((len(images), self.embedding_dim), dtype=torch.float32, device=self.device)
+        for start in range(0, len(images), IMAGE_BATCH_SIZE):
+            batch = images[start:start + IMAGE_BATCH_SIZE]
+
+            # frames from split_video_to_frames arrive as one uint8 array, preprocess them as a tensor batch
+            if isinstance(batch, np.ndarray) and batch.ndim == 4:
+                image_batch = self._preprocess_frames(batch)
             else:
-                raise ValueError(f"Unsupported image type: {type(img)}")
+                processed_images = [self.preprocess(_to_pil(img)) for img in batch]
 
-            processed_images.append(self.preprocess(pil_img))
+                stacked = torch.empty(
+                    (len(processed_images), *processed_images[0].shape),
+                    pin_memory=self.device.startswith("cuda")
+                )
+                torch.stack(processed_images, out=stacked)
+                image_batch = self._to_device(stacked).to(self.model.dtype)
 
-        image_batch = torch.stack(processed_images).to(self.device)
+            with torch.inference_mode(), self._autocast():
+                image_features = self._forward_images(image_batch)
+                features[start:start + len(image_features)] = image_features
 
-        with torch.no_grad():
-            image_features = self.model.encode_image(image_batch)
-            image_features = image_features / image_features.norm(dim=-1, keepdim=True)
+        # on CPU this shares memory with the tensor, on GPU it is the single copy back
+        return features.cpu().numpy()
 
-        return image_features.cpu().numpy().astype(np.float32)
+    def encode_images_iter(self, images: Iterable, batch_size: int = IMAGE_BATCH_SIZE) -> Iterator[np.ndarray]:
+        # pulls batch_size images at a time from a generator such as
+        # ProcessingManager.iter_video_frames, so only one batch of frames is alive at once
+        images = iter(images)
+        while batch := list(itertools.islice(images, batch_size)):
+            if all(isinstance(img, np.ndarray) for img in batch):
+                batch = np.stack(batch)
+            yield self.encode_images(batch)
 
     
     def encode_text(self, text: Union[str, List[str]]) -> np.ndarray:
         if isinstance(text, str):
-            text = [text]
-        
-        truncated_texts = []
-        for t in text:
-            truncated_texts.append(t[:300] if len(t) > 300 else t)
-        
-        text_tokens = clip.tokenize(truncated_texts, truncate=True).to(self.device)
+            return self._cached_encode_text(text[:MAX_TEXT_CHARS])
+        result = self._encode_texts([t[:MAX_TEXT_CHARS] for t in text])
+        return result.ravel() if len(text) == 1 else result
+
+    def _encode_single_text(self, text: str) -> np.ndarray:
+        result = self._encode_texts([text]).ravel()
+        # the same array is handed to every caller that hits the cache
+        result.flags.writeable = False
+        return result
+
+    def _encode_texts(self, texts: List[str]) -> np.ndarray:
+        text_tokens = clip.tokenize(texts, truncate=True).to(self.device)
         
-        with torch.no_grad():
+        with torch.inference_mode(), self._autocast():
             text_features = self.model.encode_text(text_tokens)
             text_features = text_features / text_features.norm(dim=-1, keepdim=True)
         
-        result = text_features.cpu().numpy()
-        return result.flatten() if len(text) == 1 else result
+        return text_features.float().cpu().numpy()
 
 
 _vectorizer_instance: Optional[Vectorizer] = None